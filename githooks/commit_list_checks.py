@@ -232,7 +232,7 @@ class CheckContributors(CommitListCheck):
             yield (
                 Severity.ERROR,
                 '提交 {} 的作者使用的名字 "{}" 而不是 "{}", 而两者的邮箱是一致的'
-                .format(commit, contributor.name, other.name),
+                .format(commit, contributor.name_str, other.name_str),
             )
 
         domain = contributor.get_email_domain()
@@ -248,5 +248,5 @@ class CheckContributors(CommitListCheck):
             yield (
                 Severity.ERROR,
                 '提交 {} 的作者使用了一个不同的邮箱 "{}" 而之前同名作者的邮箱是 "{}"'
-                .format(commit, contributor.email, other.email),
+                .format(commit, contributor.email_str, other.email_str),
             )
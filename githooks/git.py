@@ -4,14 +4,160 @@ Copyright (c) 2021 Scott Lau
 Portions Copyright (c) 2021 InnoGames GmbH
 Portions Copyright (c) 2021 Emre Hasegeli
 """
+import atexit
 import logging
+import re
+import sys
 
+from functools import lru_cache
+from os import environ
 from os.path import isabs, join as joinpath, normpath
-from subprocess import check_output
+from subprocess import check_output, CalledProcessError, Popen, PIPE
 
 from githooks.utils import get_exe_path, get_extension, decode_str
 
-git_exe_path = get_exe_path('git')
+# SC_GIT_EXE can be set to skip searching the PATH on every run.
+git_exe_path = environ.get('SC_GIT_EXE') or get_exe_path('git')
+
+# The tags are written in brackets in the beginning of the commit summary
+_TAGS_RE = re.compile(r'(?:\[[^\]]*\])+')
+_TAG_RE = re.compile(r'\[([^\]]*)\]')
+# The commits tagged with these are allowed to have failing content
+_SKIP_TAGS = frozenset(('HOTFIX', 'MESS', 'TEMP', 'WIP'))
+
+# There are only a few file modes in practice, so we share the strings.
+_MODE_CACHE = {
+    m: sys.intern(m)
+    for m in ('100644', '100755', '120000', '040000', '160000', '100664')
+}
+
+
+def _get_git_version():
+    """Return the major and minor version of git as a tuple"""
+    output = decode_str(check_output([git_exe_path, '--version']))
+    match = re.search(r'(\d+)\.(\d+)', output)
+    if not match:
+        return 0, 0
+    return int(match.group(1)), int(match.group(2))
+
+
+class GitCatFile(object):
+    """Long running "git cat-file" process to query objects over a pipe
+
+    Spawning a new git process for every object dominates the run time
+    when many commits and files are inspected.  We start the process once,
+    and then write the object names to its input, and read the framed
+    responses back.  Git 2.36 and later can answer both the content and
+    the info requests on a single "--batch-command" process.  We start
+    separate "--batch" and "--batch-check" processes on older versions.
+    """
+
+    def __init__(self):
+        self.batch_command = _get_git_version() >= (2, 36)
+        if self.batch_command:
+            self.proc = self._start('--batch-command')
+            self.check_proc = self.proc
+        else:
+            self.proc = self._start('--batch')
+            self.check_proc = self._start('--batch-check')
+
+    @staticmethod
+    def _start(batch_option):
+        return Popen(
+            [git_exe_path, 'cat-file', batch_option],
+            stdin=PIPE,
+            stdout=PIPE,
+        )
+
+    @staticmethod
+    def _request_header(proc, request, spec):
+        # The requests are separated by newlines, so a spec containing one
+        # would break the framing of all of the following responses.
+        if b'\n' in spec:
+            raise ValueError(
+                'Cannot request git object {}'.format(decode_str(spec))
+            )
+        proc.stdin.write(request + b'\n')
+        proc.stdin.flush()
+        header = proc.stdout.readline()
+        header_split = header.split()
+        # The header is "<object_id> <type> <size>" for the found objects,
+        # and "<spec> missing" or "<spec> ambiguous" otherwise.
+        if len(header_split) != 3 or not header_split[2].isdigit():
+            raise ValueError(
+                'Cannot read git object {}'.format(decode_str(spec))
+            )
+        return header_split
+
+    def get_info(self, spec):
+        """Return the object type and size of the spec as bytes"""
+        request = b'info ' + spec if self.batch_command else spec
+        object_id, object_type, size = self._request_header(
+            self.check_proc, request, spec
+        )
+        return object_type, int(size)
+
+    def get_content(self, spec):
+        """Return the object content of the spec as bytes"""
+        request = b'contents ' + spec if self.batch_command else spec
+        size = int(self._request_header(self.proc, request, spec)[2])
+        # The content is followed by a newline.
+        return self.proc.stdout.read(size + 1)[:-1]
+
+    def get_head(self, spec, amount):
+        """Return only the beginning of the object content of the spec
+
+        We still have to consume the rest of the content from the pipe,
+        but we don't keep it in the memory.
+        """
+        request = b'contents ' + spec if self.batch_command else spec
+        size = int(self._request_header(self.proc, request, spec)[2])
+        head = self.proc.stdout.read(min(amount, size))
+        # The content is followed by a newline.
+        remaining = size + 1 - len(head)
+        while remaining:
+            chunk = self.proc.stdout.read(min(remaining, 65536))
+            if not chunk:
+                raise EOFError('git cat-file exited unexpectedly')
+            remaining -= len(chunk)
+        return head
+
+    def close(self):
+        for proc in {self.proc, self.check_proc}:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                # The process has already exited.
+                pass
+            proc.wait()
+
+
+_CATFILE = None
+
+
+def _catfile():
+    global _CATFILE
+    if _CATFILE is None:
+        _CATFILE = GitCatFile()
+        atexit.register(_CATFILE.close)
+    return _CATFILE
+
+
+@lru_cache(maxsize=1)
+def _get_remote_project_name():
+    """Get the project name from the URL of the origin remote
+
+    The remote doesn't change while we are running, so we ask git only
+    once.
+    """
+    url = decode_str(check_output(
+        [git_exe_path, 'config', '--get', 'remote.origin.url']
+    )).strip()
+    # The URL can be a path or scp-like "git@host:group/project.git".
+    name = url.rstrip('/').rsplit('/', 1)[-1].rsplit(':', 1)[-1]
+    if name.endswith('.git'):
+        name = name[:-len('.git')]
+    return name
 
 
 class CommitList(list):
@@ -28,16 +174,82 @@ class CommitList(list):
             name += ' ({})'.format(self.branch_name)
         return name
 
+    def prefetch_changed_files(self):
+        """Fetch the changed and binary files of all commits at once
+
+        A single "git log" run on all of the commits returns the same
+        information as running "git diff-tree" and "git log --numstat"
+        on every one of them.
+        """
+        commits = {
+            c.commit_id: c for c in self
+            if c.changed_files is None or c.binary_files is None
+        }
+        if not commits:
+            return
+        output = check_output([
+            git_exe_path,
+            'log',
+            '--stdin',              # Read the commit ids from the input
+            '--no-walk=unsorted',   # Only the given commits in given order
+            '--root',               # Get the initial commit as additions
+            '--pretty=format:commit %H',
+            '--raw',                # Get the modes and the object ids
+            '--numstat',            # Get the binary files
+            '-z',                   # Separate the records and paths by NUL
+            '--no-abbrev',          # Get the full object ids
+            '--break-rewrites',     # Get rewrites as additions
+            '--no-renames',         # Get renames as additions
+            '--diff-filter=AM',     # Only additions and modifications
+        ], input='\n'.join(commits).encode())
+        # Merge commits have no output at all, so we start with empty lists.
+        for commit in commits.values():
+            commit.changed_files = []
+            commit.binary_files = []
+        commit = None
+        records = iter(output.split(b'\0'))
+        for record in records:
+            # The commit line is followed by the first record of the commit
+            # after a newline.
+            if record.startswith(b'commit '):
+                commit_line, _, record = record.partition(b'\n')
+                commit = commits[commit_line[len(b'commit '):].decode()]
+            if record.startswith(b':'):
+                commit.changed_files.append(
+                    commit._parse_changed_file(record, next(records))
+                )
+            elif record:
+                commit._parse_binary_file(record)
+
 
 class Commit(object):
     """Routines on a single commit"""
     null_commit_id = '0000000000000000000000000000000000000000'
+    __slots__ = (
+        'commit_id',
+        'commit_list',
+        'content_fetched',
+        'summary_fetched',
+        'changed_files',
+        'binary_files',
+        '_changed_files_set',
+        '_tree_paths',
+        '_raw_content',
+        '_parents',
+        '_author',
+        '_committer',
+        '_message_lines',
+        '_summary',
+    )
 
     def __init__(self, commit_id, commit_list=None):
         self.commit_id = commit_id
         self.commit_list = commit_list
+        self._changed_files_set = None
+        self._tree_paths = None
+        self._raw_content = None
         self.content_fetched = False
-        self.project_fetched = False
+        self.summary_fetched = False
         self.changed_files = None
         self.binary_files = None
 
@@ -53,64 +265,86 @@ class Commit(object):
     def __eq__(self, other):
         return isinstance(other, Commit) and self.commit_id == other.commit_id
 
+    def __hash__(self):
+        return hash(self.commit_id)
+
     def get_new_commit_list(self, branch_name):
-        """Get the list of parent new commits in order"""
-        output = decode_str(check_output([
+        """Get the list of parent new commits in order
+
+        We read the output as a stream to avoid keeping another copy of
+        all of the commit ids in the memory."""
+        args = [
             git_exe_path,
             'rev-list',
             self.commit_id,
             '--not',
             '--all',
             '--reverse',
-        ]))
+        ]
         commit_list = CommitList([], branch_name)
-        for commit_id in output.splitlines():
-            commit = Commit(commit_id, commit_list)
-            commit_list.append(commit)
+        with Popen(args, stdout=PIPE) as proc:
+            for line in proc.stdout:
+                commit = Commit(line.rstrip(b'\n').decode(), commit_list)
+                commit_list.append(commit)
+        if proc.returncode:
+            raise CalledProcessError(proc.returncode, args)
         return commit_list
 
+    def _get_raw_content(self):
+        content = self._raw_content
+        if content is None:
+            content = _catfile().get_content(self.commit_id.encode())
+        return content
+
+    def _parse_parents(self, header):
+        self._parents = [
+            Commit(decode_str(line[len(b'parent '):].rstrip()))
+            for line in header.split(b'\n')
+            if line.startswith(b'parent ')
+        ]
+
+    def _fetch_summary_only(self):
+        """Fetch only the parents and the summary of the commit
+
+        Most of the checks need only the summary, so we avoid parsing
+        the contributors and decoding the whole message for them.  We keep
+        the raw content to parse the rest without asking git again.
+        """
+        self._raw_content = self._get_raw_content()
+        header, _, body = self._raw_content.partition(b'\n\n')
+        self._parse_parents(header)
+        # We split the first line as bytes to get the same summary as
+        # get_message_lines(), for example without the carriage return.
+        first_line = body.split(b'\n', 1)[0].splitlines()
+        self._summary = decode_str(first_line[0]) if first_line else ''
+        self.summary_fetched = True
+
     def _fetch_content(self):
-        content = check_output(
-            [git_exe_path, 'cat-file', '-p', self.commit_id]
-        )
-        self._parents = []
-        self._message_lines = []
-        # The commit message starts after the empty line.  We iterate until
-        # we find one, and then consume the rest as the message.
-        lines = iter(content.splitlines())
-        for line in lines:
-            if not line:
-                break
-            if line.startswith(b'parent '):
-                self._parents.append(Commit(line[len(b'parent '):].rstrip()))
-            elif line.startswith(b'author '):
-                self._author = Contributor.parse(line[len(b'author '):])
-            elif line.startswith(b'committer '):
-                self._committer = Contributor.parse(line[len(b'committer '):])
-        for line in lines:
-            self._message_lines.append(decode_str(line))
+        content = self._get_raw_content()
+        self._raw_content = None
+        # The commit message starts after the first empty line.  We only
+        # need to go through the header lines one by one.
+        header, _, body = content.partition(b'\n\n')
+        self._parse_parents(header)
+        for line in header.split(b'\n'):
+            key, _, value = line.partition(b' ')
+            if key == b'author':
+                self._author = Contributor.parse(value)
+            elif key == b'committer':
+                self._committer = Contributor.parse(value)
+        # We split the lines as bytes and decode them one by one, so a line
+        # we cannot decode doesn't affect the others.
+        self._message_lines = [decode_str(line) for line in body.splitlines()]
+        self._summary = self._message_lines[0] if self._message_lines else ''
         self.content_fetched = True
-
-    def _get_project_info(self):
-        content = check_output(
-            [git_exe_path, 'remote', '-v']
-        )
-        self._projects = None
-        lines = iter(content.splitlines())
-        temp = [str(_, encoding='utf-8') for _ in lines if "push" in str(_, encoding='utf-8')][0]
-        line = temp.replace(" ", "\t").split("\t")[1]
-        project_name = line.split("/")[-1]
-        self._projects = project_name.split(".")[0]
-        self.project_fetched = True
+        self.summary_fetched = True
 
     def get_projects(self):
-        if not self.project_fetched:
-            self._get_project_info()
-        return self._projects
+        return _get_remote_project_name()
 
     def get_parents(self):
-        if not self.content_fetched:
-            self._fetch_content()
+        if not self.summary_fetched:
+            self._fetch_summary_only()
         return self._parents
 
     def get_author(self):
@@ -133,81 +367,130 @@ class Commit(object):
         return self._message_lines
 
     def get_summary(self):
-        return self.get_message_lines()[0]
+        if not self.summary_fetched:
+            self._fetch_summary_only()
+        return self._summary
 
     def parse_tags(self):
-        tags = []
-        rest = self.get_summary()
-        while rest.startswith('[') and ']' in rest:
-            end_index = rest.index(']')
-            tags.append(rest[1:end_index])
-            rest = rest[end_index + 1:]
-        return tags, rest
+        summary = self.get_summary()
+        match = _TAGS_RE.match(summary)
+        if not match:
+            return [], summary
+        return _TAG_RE.findall(match.group(0)), summary[match.end():]
 
     def content_can_fail(self):
-        return not any(
-            t in ['HOTFIX', 'MESS', 'TEMP', 'WIP']
-            for t in self.parse_tags()[0]
-        )
+        tags, _ = self.parse_tags()
+        return not any(t in _SKIP_TAGS for t in tags)
+
+    def _parse_changed_file(self, record, file_path):
+        """Parse a NUL separated raw diff record as bytes into a CommittedFile
+
+        The record looks like ":100644 100644 <src_id> <dst_id> M" and it
+        is followed by the path as the next record.
+        """
+        record_split = record.split(b' ')
+        assert len(record_split) == 5
+        assert record_split[0].startswith(b':')
+        file_mode = record_split[1].decode()
+        # sc add object_id
+        object_id = record_split[3].decode()
+        return CommittedFile(decode_str(file_path), self, file_mode, object_id)
+
+    def _parse_binary_file(self, record):
+        """Parse a NUL separated numstat record and keep the binary file
+
+        The numbers of added and deleted lines are "-" for binary files.
+        """
+        record_split = record.split(b'\t', 2)
+        if len(record_split) == 3:
+            if b"-" == record_split[0] and b"-" == record_split[1]:
+                self.binary_files.append(decode_str(record_split[2]))
 
     def get_changed_files(self):
         """Return the list of added or modified files on a commit"""
+        if self.changed_files is None and self.commit_list is not None:
+            self.commit_list.prefetch_changed_files()
         if self.changed_files is None:
-            output = decode_str(check_output([
+            output = check_output([
                 git_exe_path,
                 'diff-tree',
                 '-r',
+                '-z',                   # Separate the records and paths by NUL
                 '--root',               # Get the initial commit as additions
                 '--no-commit-id',       # We already know the commit id.
                 '--break-rewrites',     # Get rewrites as additions
                 '--no-renames',         # Get renames as additions
                 '--diff-filter=AM',     # Only additions and modifications
                 self.commit_id,
-            ]))
-            changed_files = []
-            for line in output.splitlines():
-                line_split = line.split(None, 5)
-                assert len(line_split) == 6
-                assert line_split[0].startswith(':')
-                file_mode = line_split[1]
-                # sc add object_id
-                object_id = line_split[3]
-                file_path = line_split[5]
-                changed_files.append(CommittedFile(file_path, self, file_mode, object_id))
-            self.changed_files = changed_files
+            ])
+            records = iter(output.split(b'\0'))
+            self.changed_files = [
+                self._parse_changed_file(record, next(records))
+                for record in records if record
+            ]
         return self.changed_files
 
+    def get_changed_files_set(self):
+        """Return the added or modified files on a commit as a set"""
+        if self._changed_files_set is None:
+            self._changed_files_set = frozenset(self.get_changed_files())
+        return self._changed_files_set
+
+    def get_tree_paths(self):
+        """Return the paths of all files and directories on the commit"""
+        if self._tree_paths is None:
+            output = check_output([
+                git_exe_path,
+                'ls-tree',
+                '--name-only',
+                '-r',
+                '-t',                   # Include the directories
+                '-z',                   # Don't quote the paths
+                self.commit_id,
+            ])
+            self._tree_paths = frozenset(
+                decode_str(path) for path in output.split(b'\0') if path
+            )
+        return self._tree_paths
+
     def get_binary_files(self):
         """Return the binary files on a commit"""
+        if self.binary_files is None and self.commit_list is not None:
+            self.commit_list.prefetch_changed_files()
         if self.binary_files is None:
-            output = decode_str(check_output([
+            output = check_output([
                 git_exe_path,
                 'log',
-                '--pretty=format:%H -M100%',   # pretty format
-                '--numstat',       # number state of the file
+                '--format=',            # We only need the numstat records
+                '--root',               # Get the initial commit as additions
+                '--numstat',            # number state of the file
+                '-z',                   # Separate the records by NUL
                 '--no-commit-id',       # We already know the commit id.
                 '--break-rewrites',     # Get rewrites as additions
                 '--no-renames',         # Get renames as additions
                 '--diff-filter=AM',     # Only additions and modifications
                 "{}^!".format(self.commit_id),
-            ]))
-            binary_files = []
-            for line in output.splitlines():
-                line_split = line.split('\t')
-                if len(line_split) == 3:
-                    if "-" == line_split[0] and "-" == line_split[1]:
-                        binary_files.append(line_split[2])
-            self.binary_files = binary_files
+            ])
+            self.binary_files = []
+            for record in output.split(b'\0'):
+                self._parse_binary_file(record)
         return self.binary_files
 
 
 class Contributor(object):
-    """Routines on contribution properties of a commit"""
+    """Routines on contribution properties of a commit
+
+    The name and the email are kept as bytes.  Most of the time they are
+    only compared, so we decode them only when they are asked as strings.
+    """
+    __slots__ = ('name', 'email', 'timestamp', '_name_str', '_email_str')
 
     def __init__(self, name, email, timestamp):
         self.name = name
         self.email = email
         self.timestamp = timestamp
+        self._name_str = None
+        self._email_str = None
 
     @classmethod
     def parse(cls, line):
@@ -215,24 +498,41 @@ class Contributor(object):
         name, line = line.split(b' <', 1)
         email, line = line.split(b'> ', 1)
         timestamp, line = line.split(b' ', 1)
-        return cls(decode_str(name), decode_str(email), int(timestamp))
+        return cls(name, email, int(timestamp))
+
+    @property
+    def name_str(self):
+        if self._name_str is None:
+            self._name_str = decode_str(self.name)
+        return self._name_str
+
+    @property
+    def email_str(self):
+        if self._email_str is None:
+            self._email_str = decode_str(self.email)
+        return self._email_str
 
     def get_email_domain(self):
-        return self.email.split('@', 1)[-1]
+        return decode_str(self.email.split(b'@', 1)[-1])
 
 
 class CommittedFile(object):
     """Routines on a single committed file"""
+    __slots__ = (
+        'path',
+        'commit',
+        'mode',
+        'content',
+        'object_id',
+    )
 
     def __init__(self, path, commit=None, mode=None, object_id=None):
         self.path = path
         self.commit = commit
-        assert mode is None or len(mode) == 6
-        self.mode = mode
+        self.mode = _MODE_CACHE.get(mode, mode)
         self.content = None
         # sc add object id
         self.object_id = object_id
-        self.project_fetched = False
 
     def __str__(self):
         return '文件 {} 位于提交 {}'.format(self.path, self.commit)
@@ -244,35 +544,18 @@ class CommittedFile(object):
             self.commit == other.commit
         )
 
-    def _get_project_info(self):
-        content = check_output(
-            [git_exe_path, 'remote', '-v']
-        )
-        self._projects = None
-        lines = iter(content.splitlines())
-        temp = [str(_, encoding='utf-8') for _ in lines if "push" in str(_, encoding='utf-8')][0]
-        line = temp.replace(" ", "\t").split("\t")[1]
-        project_name = line.split("/")[-1]
-        self._projects = project_name.split(".")[0]
-        self.project_fetched = True
+    def __hash__(self):
+        commit_id = self.commit.commit_id if self.commit is not None else None
+        return hash((self.path, commit_id))
 
     def get_projects(self):
-        if not self.project_fetched:
-            self._get_project_info()
-        return self._projects
+        return _get_remote_project_name()
 
     def exists(self):
-        return bool(check_output([
-            git_exe_path,
-            'ls-tree',
-            '--name-only',
-            '-r',
-            self.commit.commit_id,
-            self.path,
-        ]))
+        return self.path in self.commit.get_tree_paths()
 
     def changed(self):
-        return self in self.commit.get_changed_files()
+        return self in self.commit.get_changed_files_set()
 
     def regular(self):
         return self.mode[:2] == '10'
@@ -298,48 +581,68 @@ class CommittedFile(object):
 
     def get_file_size(self):
         try:
-            output = check_output([
-                git_exe_path,
-                'cat-file',
-                '-s',  # show file size
-                self.object_id,
-            ])
+            size = _catfile().get_info(self.object_id.encode())[1]
         except Exception as e:
             logging.info("get_file_size Error: %s" % e)
-            output = -1
-        return int(output)
+            size = -1
+        return size
 
     def get_extension(self):
         return get_extension(self.path)
 
+    def _get_object_spec(self):
+        """Get the name to request the file content from git
+
+        We prefer the object id, when we know it, as the path can contain
+        any character."""
+        if self.object_id:
+            return self.object_id.encode()
+        return (self.commit.commit_id + ':' + self.path).encode()
+
     def get_content(self):
         """Get the file content as binary"""
         if self.content is None:
-            self.content = check_output([
-                git_exe_path, 'show', self.commit.commit_id + ':' + self.path
-            ])
+            self.content = _catfile().get_content(self._get_object_spec())
         return self.content
 
+    def get_head(self, amount=128):
+        """Get the beginning of the file content as binary"""
+        if self.content is not None:
+            return self.content[:amount]
+        return _catfile().get_head(self._get_object_spec(), amount)
+
+    def _get_shebang_split(self):
+        """Split the first line of the file content after "#!"
+
+        The shebang is limited to the first line, so we usually don't need
+        to read the whole file."""
+        if not self.regular():
+            return []
+        head_size = 128
+        head = self.get_head(head_size)
+        if not head.startswith(b'#!'):
+            return []
+        if b'\n' not in head and len(head) == head_size:
+            # The first line is longer than the head, so we need the rest.
+            head = self.get_content()
+        line = head.split(b'\n', 1)[0]
+        return line[len(b'#!'):].split(None, 2)
+
     def get_shebang(self):
         """Get the shebang from the file content"""
-        if not self.regular():
-            return None
-        content = self.get_content()
-        if not content.startswith(b'#!'):
+        shebang_split = self._get_shebang_split()
+        if not shebang_split:
             return None
-        content = content[len(b'#!'):].strip()
-        return decode_str(content.split(None, 1)[0])
+        return decode_str(shebang_split[0])
 
     def get_shebang_exe(self):
         """Get the executable from the shebang"""
-        shebang = self.get_shebang()
-        if not shebang:
+        shebang_split = self._get_shebang_split()
+        if not shebang_split:
             return None
-        if shebang == '/usr/bin/env':
-            rest = self.get_content().splitlines()[0][len(b'#!/usr/bin/env'):]
-            rest_split = rest.split(None, 1)
-            if rest_split:
-                return decode_str(rest_split[0])
+        shebang = decode_str(shebang_split[0])
+        if shebang == '/usr/bin/env' and len(shebang_split) > 1:
+            return decode_str(shebang_split[1])
         return shebang.rsplit('/', 1)[-1]
 
     def get_symlink_target(self):
@@ -5,9 +5,11 @@ Portions Copyright (c) 2021 InnoGames GmbH
 Portions Copyright (c) 2021 Emre Hasegeli
 """
 
+from functools import lru_cache
 from os import environ, access, X_OK
 
 
+@lru_cache(maxsize=None)
 def get_exe_path(exe):
     for dir_path in environ['PATH'].split(':'):
         path = dir_path.strip('"') + '/' + exe